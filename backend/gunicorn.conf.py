@@ -0,0 +1,18 @@
+"""
+Gunicorn config for production:
+
+    gunicorn main:app -c gunicorn.conf.py
+
+Runs several Uvicorn worker processes so CPU-bound HTML parsing isn't
+serialized by the GIL. MAX_CONCURRENT_SCRAPES applies per worker.
+"""
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
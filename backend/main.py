@@ -1,24 +1,82 @@
 import asyncio
+import logging
 import os
-from typing import List, Dict, Any
-from fastapi import FastAPI, HTTPException
+import queue
+import re
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Dict, Any, Optional, Tuple
+import httpx
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
-from scraper import scrape_walmart_product
-
+# Load .env before importing scraper, which reads its settings at import time
 load_dotenv()
 
+from scraper import scrape_walmart_product, open_cache, close_cache
+
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8000))
 MAX_CONCURRENT_SCRAPES = int(os.getenv("MAX_CONCURRENT_SCRAPES", 3))
 HEADLESS = os.getenv("HEADLESS", "true").lower() in ("1", "true", "yes")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+
+log = logging.getLogger("api")
+
+# Walmart item IDs are typically 6-20 alphanumeric characters (dashes/underscores
+# allowed, but not on their own)
+_ID_RE = re.compile(r'(?=.*[A-Za-z0-9])[A-Za-z0-9_-]{6,20}')
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared resources on startup and release them on shutdown."""
+    # Log records are queued and written by a background thread, so request
+    # handlers never block on stdout
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    queue_handler = QueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    for name in ("api", "scraper"):
+        logging.getLogger(name).setLevel(LOG_LEVEL)
+    listener.start()
+    
+    log.info("🚀 Starting Walmart Review Scraper API on %s:%s", HOST, PORT)
+    log.info("📝 Headless mode: %s", HEADLESS)
+    log.info("🔄 Max concurrent scrapes: %s", MAX_CONCURRENT_SCRAPES)
+    
+    # One pooled client and one concurrency limit shared by every request
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        # Compressed responses are decoded by httpx (br needs the brotli package)
+        headers={"Accept-Encoding": "gzip, br"},
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_SCRAPES * 2,
+            max_keepalive_connections=MAX_CONCURRENT_SCRAPES,
+        ),
+    )
+    app.state.sem = asyncio.Semaphore(MAX_CONCURRENT_SCRAPES)
+    await open_cache()
+    yield
+    await close_cache()
+    await app.state.http.aclose()
+    
+    root_logger.removeHandler(queue_handler)
+    listener.stop()
+
 
 app = FastAPI(
     title="Walmart Review Scraper API",
     description="API for scraping Walmart product reviews",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -35,6 +93,7 @@ class ScrapeRequest(BaseModel):
     """Request model for scraping endpoint."""
     item_ids: List[str] = Field(..., description="List of Walmart item IDs to scrape", max_items=10)
     max_reviews_per_item: int = Field(default=1000, ge=1, le=10000, description="Maximum reviews to scrape per item")
+    bypass_cache: bool = Field(default=False, description="Skip ScraperAPI's cache and fetch a fresh page")
 
 
 
@@ -64,59 +123,62 @@ async def health():
 
 
 @app.post("/scrape", response_model=ScrapeResponse)
-async def scrape_endpoint(req: ScrapeRequest):
+async def scrape_endpoint(req: ScrapeRequest, request: Request):
     """
     Scrape Walmart product reviews for given item IDs.
     
     Args:
         req: ScrapeRequest containing item_ids and max_reviews_per_item
+        request: Incoming request, used to reach the shared client and semaphore
     
     Returns:
         ScrapeResponse with results and errors
     """
-    results = []
-    errors = []
-
-    # Create semaphore for concurrent scraping limit
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SCRAPES)
-
-    async def _run_one(item_id: str):
-        """Run scraper for a single item."""
-        async with semaphore:
-            try:
-                print(f"🚀 Starting scrape for item: {item_id}")
-                out = await scrape_walmart_product(
-                    item_id.strip(),
-                    max_reviews=req.max_reviews_per_item,
-                    headless=HEADLESS
-                )
-                results.append(out)
-                print(f"✅ Successfully scraped item: {item_id}")
-            except Exception as e:
-                error_msg = str(e)
-                print(f"❌ Error scraping item {item_id}: {error_msg}")
-                
-                # Make error message user-friendly
-                user_friendly_msg = error_msg
-                if "Failed to scrape" in error_msg or "GET https://" in error_msg:
-                    user_friendly_msg = "Could not access this product. Please verify the item ID is correct."
-                elif "timeout" in error_msg.lower():
-                    user_friendly_msg = "Request timed out. Please try again."
-                elif "connection" in error_msg.lower():
-                    user_friendly_msg = "Network connection issue. Please try again."
-                
-                errors.append({
-                    "item_id": item_id,
-                    "error": user_friendly_msg
-                })
+    # Process-wide concurrent scraping limit and HTTP client
+    semaphore = request.app.state.sem
+    client = request.app.state.http
+    
+    # One timestamp for the whole batch
+    scraped_at = datetime.now(timezone.utc).isoformat()
+
+    async def _run_one(item_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, str]]]:
+        """Run scraper for a single item, returning (result, None) or (None, error)."""
+        try:
+            log.debug("🚀 Starting scrape for item: %s", item_id)
+            out = await scrape_walmart_product(
+                item_id.strip(),
+                client,
+                max_reviews=req.max_reviews_per_item,
+                headless=HEADLESS,
+                bypass_cache=req.bypass_cache,
+                scraped_at=scraped_at,
+                semaphore=semaphore
+            )
+            log.info("✅ Successfully scraped item: %s", item_id)
+            return out, None
+        except Exception as e:
+            error_msg = str(e)
+            log.warning("❌ Error scraping item %s: %s", item_id, error_msg)
+            
+            # Make error message user-friendly
+            user_friendly_msg = error_msg
+            if "Failed to scrape" in error_msg or "GET https://" in error_msg:
+                user_friendly_msg = "Could not access this product. Please verify the item ID is correct."
+            elif "timeout" in error_msg.lower():
+                user_friendly_msg = "Request timed out. Please try again."
+            elif "connection" in error_msg.lower():
+                user_friendly_msg = "Network connection issue. Please try again."
+            
+            return None, {
+                "item_id": item_id,
+                "error": user_friendly_msg
+            }
 
     # Filter and validate item IDs
-    valid_ids = []
-    for item_id in req.item_ids:
-        cleaned = item_id.strip()
-        # Walmart item IDs are typically 6-20 alphanumeric characters
-        if cleaned and len(cleaned) >= 6 and len(cleaned) <= 20 and cleaned.replace('-', '').replace('_', '').isalnum():
-            valid_ids.append(cleaned)
+    valid_ids = [c for c in (i.strip() for i in req.item_ids) if c and _ID_RE.fullmatch(c)]
+    
+    # Drop duplicate IDs, keeping the first occurrence's position
+    valid_ids = list(dict.fromkeys(valid_ids))
     
     if not valid_ids:
         raise HTTPException(
@@ -130,18 +192,19 @@ async def scrape_endpoint(req: ScrapeRequest):
             detail="Maximum 10 items can be scraped at once. Please reduce the number of item IDs."
         )
 
-    # Create tasks for all items
-    tasks = [asyncio.create_task(_run_one(item_id)) for item_id in valid_ids]
+    # Run all items concurrently; anything _run_one didn't catch becomes an error entry
+    outs = await asyncio.gather(*[_run_one(item_id) for item_id in valid_ids], return_exceptions=True)
+    outs = [
+        out if isinstance(out, tuple) else (None, {"item_id": item_id, "error": str(out)})
+        for item_id, out in zip(valid_ids, outs)
+    ]
     
-    # Wait for all tasks to complete
-    await asyncio.gather(*tasks, return_exceptions=True)
+    results = [result for result, _ in outs if result is not None]
+    errors = [error for _, error in outs if error is not None]
     
     return {"results": results, "errors": errors}
 
 
 if __name__ == "__main__":
     import uvicorn
-    print(f"🚀 Starting Walmart Review Scraper API on {HOST}:{PORT}")
-    print(f"📝 Headless mode: {HEADLESS}")
-    print(f"🔄 Max concurrent scrapes: {MAX_CONCURRENT_SCRAPES}")
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    uvicorn.run(app, host=HOST, port=PORT)
@@ -1,31 +1,401 @@
 import asyncio
-import json
+import heapq
+import logging
+from contextlib import nullcontext
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
 import re
 import os
-from dotenv import load_dotenv
+import time
+import zlib
 
-from scraperapi_sdk import ScraperAPIClient
-from bs4 import BeautifulSoup
+import aiosqlite
+import httpx
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
 
-load_dotenv()
+log = logging.getLogger("scraper")
 
 SCRAPER_API_KEY = os.getenv("SCRAPER_API_KEY", "")
+SCRAPER_API_URL = "https://api.scraperapi.com/"
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache.db")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 3600))
 
+# Patterns used by the parse filter and HTML review fallback, compiled once
+_RE_REVIEW = re.compile(r'review', re.I)
+_RE_STAR = re.compile(r'(\d+)\s*(?:star|out of)', re.I)
 
-async def scrape_walmart_product(item_id: str, max_reviews: int = 50, headless: bool = False) -> Dict[str, Any]:
+# CSS selectors for review blocks in the HTML fallback, tried in order
+_REVIEW_SELECTORS = (
+    'div[data-testid*="review" i]',
+    'div[class*="review" i]',
+    'section[class*="review" i]',
+)
+
+
+def _keep_tag(name: str, attrs: Dict[str, str]) -> bool:
+    """
+    Only keep the tags the extractor reads: title, JSON-LD and review blocks.
+    Relies on bs4 < 4.13 calling a SoupStrainer function with (name, attrs).
+    """
+    if name == 'h1':
+        return True
+    if name == 'script':
+        return attrs.get('type') == 'application/ld+json'
+    if name in ('div', 'section'):
+        classes = attrs.get('class', '')
+        if isinstance(classes, list):
+            classes = ' '.join(classes)
+        return bool(_RE_REVIEW.search(attrs.get('data-testid', '')) or _RE_REVIEW.search(classes))
+    return False
+
+
+_PARSE_ONLY = SoupStrainer(_keep_tag)
+
+# Scrapes currently running, keyed by (item_id, max_reviews, bypass_cache), so
+# concurrent calls with the same options share one fetch
+_INFLIGHT: Dict[Tuple[str, int, bool], "asyncio.Task[Dict[str, Any]]"] = {}
+
+# Local result cache, opened/closed by the app lifespan (see main.py)
+_CACHE_DB: Optional[aiosqlite.Connection] = None
+
+
+async def open_cache(path: str = CACHE_DB_PATH) -> None:
+    """Open the SQLite result cache and create its table if needed."""
+    global _CACHE_DB
+    _CACHE_DB = await aiosqlite.connect(path)
+    # WAL lets several worker processes read while one writes
+    await _CACHE_DB.execute("PRAGMA journal_mode=WAL")
+    await _CACHE_DB.execute(
+        "CREATE TABLE IF NOT EXISTS cache "
+        "(item_id TEXT PRIMARY KEY, scraped_at REAL, max_reviews INTEGER, payload BLOB)"
+    )
+    await _CACHE_DB.commit()
+
+
+async def close_cache() -> None:
+    """Close the SQLite result cache."""
+    global _CACHE_DB
+    if _CACHE_DB is not None:
+        await _CACHE_DB.close()
+        _CACHE_DB = None
+
+
+async def _cache_get(item_id: str, max_reviews: int) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached result for item_id if it is younger than CACHE_TTL_SECONDS
+    and was scraped with at least max_reviews; reviews are trimmed to max_reviews.
+    """
+    if _CACHE_DB is None:
+        return None
+    try:
+        async with _CACHE_DB.execute(
+            "SELECT payload FROM cache WHERE item_id = ? AND scraped_at > ? AND max_reviews >= ?",
+            (item_id, time.time() - CACHE_TTL_SECONDS, max_reviews),
+        ) as cursor:
+            row = await cursor.fetchone()
+    except aiosqlite.Error as e:
+        # The cache is best-effort; fall through to a live scrape
+        log.warning("⚠️  Cache read failed for %s: %s", item_id, e)
+        return None
+    if row is None:
+        return None
+    try:
+        result = orjson.loads(zlib.decompress(row[0]))
+        reviews = result["reviews"]
+    except (zlib.error, orjson.JSONDecodeError, TypeError, KeyError) as e:
+        # A truncated or corrupt row is treated as a miss
+        log.warning("⚠️  Cache entry for %s is unreadable: %s", item_id, e)
+        return None
+    if len(reviews) > max_reviews:
+        result["reviews"] = reviews[:max_reviews]
+        _categorize_reviews(result)
+    return result
+
+
+async def _cache_put(item_id: str, max_reviews: int, result: Dict[str, Any]) -> None:
+    """Store a compressed scrape result for item_id, built with max_reviews."""
+    if _CACHE_DB is None:
+        return
+    payload = zlib.compress(orjson.dumps(result))
+    try:
+        await _CACHE_DB.execute(
+            "INSERT OR REPLACE INTO cache (item_id, scraped_at, max_reviews, payload) VALUES (?, ?, ?, ?)",
+            (item_id, time.time(), max_reviews, payload),
+        )
+        await _CACHE_DB.commit()
+    except aiosqlite.Error as e:
+        # A failed write must not turn a successful scrape into an error
+        log.warning("⚠️  Cache write failed for %s: %s", item_id, e)
+
+
+def _review_from_jsonld(rev: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Build a review dict from a JSON-LD Review entry, or None if it has no content."""
+    review_data = {
+        "review_id": None,
+        "author_name": "Anonymous",
+        "rating": None,
+        "title": "",
+        "body": "",
+        "created_at": None,
+        "verified_purchase": False,
+        "location": None,
+        "helpful_count": 0,
+        "not_helpful_count": 0,
+        "images": [],
+    }
+    
+    # Author
+    author = rev.get('author')
+    if author:
+        if isinstance(author, dict):
+            review_data["author_name"] = author.get('name') or 'Anonymous'
+        else:
+            review_data["author_name"] = str(author)
+    
+    # Rating - ensure it's between 1-5
+    rating_obj = rev.get('reviewRating') or {}
+    rating_val = rating_obj.get('ratingValue') if isinstance(rating_obj, dict) else None
+    if rating_val is not None:
+        try:
+            rating_val = float(rating_val)
+            # Walmart sometimes stores as 1-5, sometimes as 0-100
+            if rating_val > 5:
+                rating_val = rating_val / 20  # Convert 0-100 to 0-5
+            review_data["rating"] = int(round(rating_val))
+        except (TypeError, ValueError, OverflowError):
+            pass
+    
+    # Title and body
+    review_data["title"] = rev.get('name', '') or rev.get('headline', '')
+    review_data["body"] = rev.get('reviewBody', '') or rev.get('description', '')
+    review_data["created_at"] = rev.get('datePublished')
+    
+    if review_data["body"] or review_data["rating"]:
+        return review_data
+    return None
+
+
+def _parse_html(html: str, max_reviews: int) -> Dict[str, Any]:
+    """
+    Extract title, rating and reviews from a product page.
+    Synchronous and CPU-bound; called via asyncio.to_thread.
+    """
+    result = {
+        "product_title": None,
+        "average_rating": None,
+        "total_ratings": None,
+        "total_reviews": None,
+        "reviews": [],
+        "best_reviews": [],
+        "worst_reviews": []
+    }
+    
+    soup = BeautifulSoup(html, 'lxml', parse_only=_PARSE_ONLY)
+    
+    # Extract title
+    log.debug("🔍 Extracting product info...")
+    title_el = soup.find('h1')
+    if title_el:
+        result["product_title"] = title_el.get_text(strip=True)
+        log.debug("✓ Title: %s...", result['product_title'][:60])
+    
+    # Extract rating and reviews from JSON-LD in a single pass, dispatching on @type
+    for script in soup.find_all('script', type='application/ld+json'):
+        # Only Product and Review entries are used; skip anything else without parsing
+        # (orjson rejects str subclasses such as NavigableString)
+        raw = str(script.string or "")
+        if raw.lstrip()[:1] not in ("{", "["):
+            continue
+        if '"Product"' not in raw and '"Review"' not in raw:
+            continue
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            continue
+        
+        for entry in (data if isinstance(data, list) else [data]):
+            if not isinstance(entry, dict):
+                continue
+            entry_type = entry.get('@type')
+            
+            if entry_type == 'Product':
+                agg = entry.get('aggregateRating')
+                if not isinstance(agg, dict):
+                    agg = {}
+                try:
+                    if agg.get('ratingValue') and result["average_rating"] is None:
+                        result["average_rating"] = float(agg['ratingValue'])
+                        log.debug("✓ Rating: %s", result['average_rating'])
+                    if agg.get('reviewCount') and result["total_ratings"] is None:
+                        result["total_ratings"] = int(agg['reviewCount'])
+                        result["total_reviews"] = int(agg['reviewCount'])
+                        log.debug("✓ Total ratings: %s", result['total_ratings'])
+                except (TypeError, ValueError):
+                    pass
+                
+                # Only the first Product with reviews supplies them; later Product
+                # entries are usually related items, not this one
+                reviews = (entry.get('review') or []) if not result["reviews"] else []
+                if not isinstance(reviews, list):
+                    reviews = [reviews]
+                if reviews:
+                    log.debug("📝 Found %d reviews in JSON-LD", len(reviews))
+            elif entry_type == 'Review':
+                reviews = [entry]
+            else:
+                continue
+            
+            for rev in reviews:
+                if len(result["reviews"]) >= max_reviews:
+                    break
+                if not isinstance(rev, dict):
+                    continue
+                review_data = _review_from_jsonld(rev)
+                if review_data is not None:
+                    result["reviews"].append(review_data)
+        
+        # Stop scanning JSON-LD once rating and reviews are both known
+        if result["average_rating"] and result["reviews"]:
+            break
+    
+    # If no reviews in JSON-LD, try to find in HTML
+    if not result["reviews"]:
+        log.debug("🔍 Looking for reviews in HTML...")
+        
+        # Try each selector until one matches; select() stops after max_reviews hits
+        review_elements = []
+        for selector in _REVIEW_SELECTORS:
+            review_elements = soup.select(selector, limit=max_reviews)
+            if review_elements:
+                break
+        
+        log.debug("📝 Found %d review elements in HTML", len(review_elements))
+        
+        for rev_el in review_elements:
+            review_data = {
+                "review_id": None,
+                "author_name": "Anonymous",
+                "rating": None,
+                "title": "",
+                "body": "",
+                "created_at": None,
+                "verified_purchase": False,
+                "location": None,
+                "helpful_count": 0,
+                "not_helpful_count": 0,
+                "images": [],
+            }
+            
+            # Try to extract rating
+            rating_text = rev_el.get_text()
+            rating_match = _RE_STAR.search(rating_text)
+            if rating_match:
+                review_data["rating"] = int(rating_match.group(1))
+            
+            # Title
+            title_el = rev_el.find(['h3', 'h4', 'h5'])
+            if title_el:
+                review_data["title"] = title_el.get_text(strip=True)
+            
+            # Body
+            body_el = rev_el.find('p')
+            if body_el:
+                review_data["body"] = body_el.get_text(strip=True)
+            
+            if review_data["body"] or review_data["title"]:
+                result["reviews"].append(review_data)
+    
+    log.debug("✓ Extracted %d reviews", len(result['reviews']))
+    
+    _categorize_reviews(result)
+    
+    return result
+
+
+def _categorize_reviews(result: Dict[str, Any]) -> None:
+    """Fill best_reviews and worst_reviews from result["reviews"]."""
+    result["best_reviews"] = []
+    result["worst_reviews"] = []
+    if not result["reviews"] or len(result["reviews"]) < 2:
+        return
+    
+    log.debug("🔍 Categorizing reviews...")
+    
+    # Split rated reviews in one pass: best is 4-5 stars, worst is 1-3 stars
+    best, worst = [], []
+    for r in result["reviews"]:
+        rating = r.get("rating") or 0
+        if rating >= 4:
+            best.append(r)
+        elif rating > 0:
+            worst.append(r)
+    
+    # Highest-rated best and lowest-rated worst, top 5 each
+    result["best_reviews"] = heapq.nlargest(5, best, key=itemgetter("rating"))
+    result["worst_reviews"] = heapq.nsmallest(5, worst, key=itemgetter("rating"))
+    
+    log.debug("✓ %d best (4-5★), %d worst (1-3★)",
+              len(result['best_reviews']), len(result['worst_reviews']))
+
+
+async def scrape_walmart_product(item_id: str, client: httpx.AsyncClient, max_reviews: int = 50,
+                                 headless: bool = False, bypass_cache: bool = False,
+                                 scraped_at: Optional[str] = None,
+                                 semaphore: Optional[asyncio.Semaphore] = None) -> Dict[str, Any]:
     """
     Scrape Walmart Canada product using ScraperAPI (simple, no render).
     Gets ~7-10 reviews per product (first page only).
+    Pages are fetched through the shared client owned by the app lifespan.
+    Results are cached locally for CACHE_TTL_SECONDS, and ScraperAPI's
+    response cache is used, unless bypass_cache is set.
+    Concurrent calls for the same item_id share a single in-flight scrape.
+    scraped_at lets a caller stamp a whole batch with one timestamp.
+    semaphore, if given, is held only around the ScraperAPI request, so
+    cache hits and joined scrapes never wait for a slot.
     """
-    print(f"\n🛒 Starting scrape for: {item_id}")
+    if scraped_at is None:
+        scraped_at = datetime.now(timezone.utc).isoformat()
+    
+    key = (item_id, max_reviews, bypass_cache)
+    task = _INFLIGHT.get(key)
+    if task is not None:
+        log.debug("🔗 Joining in-flight scrape for: %s", item_id)
+        return await asyncio.shield(task)
+    
+    task = asyncio.ensure_future(
+        _scrape_walmart_product(item_id, client, max_reviews, headless, bypass_cache, scraped_at,
+                                semaphore)
+    )
+    _INFLIGHT[key] = task
+    task.add_done_callback(lambda t: _forget_inflight(key, t))
+    # Shielded so cancelling this caller doesn't cancel the scrape for joiners
+    return await asyncio.shield(task)
+
+
+def _forget_inflight(key: Tuple[str, int, bool], task: "asyncio.Task[Dict[str, Any]]") -> None:
+    """Drop a finished scrape from _INFLIGHT and mark its exception as retrieved."""
+    _INFLIGHT.pop(key, None)
+    if not task.cancelled():
+        task.exception()
+
+
+async def _scrape_walmart_product(item_id: str, client: httpx.AsyncClient, max_reviews: int,
+                                  headless: bool, bypass_cache: bool, scraped_at: str,
+                                  semaphore: Optional[asyncio.Semaphore]) -> Dict[str, Any]:
+    """Fetch, parse and cache a single product page (see scrape_walmart_product)."""
+    log.debug("🛒 Starting scrape for: %s", item_id)
+    
+    if not bypass_cache:
+        cached = await _cache_get(item_id, max_reviews)
+        if cached is not None:
+            log.debug("✅ Served from local cache: %s", item_id)
+            return cached
     
     if not SCRAPER_API_KEY:
         raise ValueError("SCRAPER_API_KEY is required")
     
-    client = ScraperAPIClient(SCRAPER_API_KEY)
-    
     # Use SKU/Item ID directly
     product_url = f"https://www.walmart.ca/en/ip/{item_id}"
     
@@ -33,7 +403,7 @@ async def scrape_walmart_product(item_id: str, max_reviews: int = 50, headless:
         "item_id": item_id,
         "walmart_item_number": item_id,
         "product_url": product_url,
-        "scraped_at": datetime.now(timezone.utc).isoformat(),
+        "scraped_at": scraped_at,
         "product_title": None,
         "average_rating": None,
         "total_ratings": None,
@@ -45,177 +415,39 @@ async def scrape_walmart_product(item_id: str, max_reviews: int = 50, headless:
     }
     
     try:
-        print("  🔑 Connecting to ScraperAPI...")
+        log.debug("🔑 Connecting to ScraperAPI...")
         
         # Get product page
-        print(f"  📄 Fetching: {product_url}")
-        html = client.get(product_url)
+        log.debug("📄 Fetching: %s", product_url)
+        params = {"api_key": SCRAPER_API_KEY, "url": product_url, "ultra_premium": "true"}
+        if bypass_cache:
+            params["cache_control"] = "no-cache"
+        async with semaphore if semaphore is not None else nullcontext():
+            resp = await client.get(SCRAPER_API_URL, params=params)
+        log.debug("💾 From cache: %s", resp.headers.get('sa-from-cache', 'unknown'))
+        if resp.status_code >= 400:
+            raise RuntimeError(f"Failed to scrape {product_url}: HTTP {resp.status_code}")
+        html = resp.text
         
         if not html or len(html) < 100:
             raise RuntimeError("Failed to fetch page")
         
-        print(f"  ✅ Page fetched! ({len(html)} chars)")
-        
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # Extract title
-        print("  🔍 Extracting product info...")
-        title_el = soup.find('h1')
-        if title_el:
-            result["product_title"] = title_el.get_text(strip=True)
-            print(f"  ✓ Title: {result['product_title'][:60]}...")
-        
-        # Extract rating from JSON-LD
-        for script in soup.find_all('script', type='application/ld+json'):
-            try:
-                data = json.loads(script.string)
-                if isinstance(data, dict) and data.get('@type') == 'Product':
-                    agg = data.get('aggregateRating', {})
-                    if agg.get('ratingValue'):
-                        result["average_rating"] = float(agg['ratingValue'])
-                        print(f"  ✓ Rating: {result['average_rating']}")
-                    if agg.get('reviewCount'):
-                        result["total_ratings"] = int(agg['reviewCount'])
-                        result["total_reviews"] = int(agg['reviewCount'])
-                        print(f"  ✓ Total ratings: {result['total_ratings']}")
-                    
-                    # Extract reviews from JSON-LD if available
-                    if data.get('review'):
-                        reviews = data['review']
-                        if not isinstance(reviews, list):
-                            reviews = [reviews]
-                        
-                        print(f"  📝 Found {len(reviews)} reviews in JSON-LD")
-                        
-                        for rev in reviews[:max_reviews]:
-                            try:
-                                review_data = {
-                                    "review_id": None,
-                                    "author_name": "Anonymous",
-                                    "rating": None,
-                                    "title": "",
-                                    "body": "",
-                                    "created_at": None,
-                                    "verified_purchase": False,
-                                    "location": None,
-                                    "helpful_count": 0,
-                                    "not_helpful_count": 0,
-                                    "images": [],
-                                }
-                                
-                                # Author
-                                if rev.get('author'):
-                                    author = rev['author']
-                                    if isinstance(author, dict):
-                                        review_data["author_name"] = author.get('name', 'Anonymous')
-                                    else:
-                                        review_data["author_name"] = str(author)
-                                
-                                # Rating - ensure it's between 1-5
-                                rating_obj = rev.get('reviewRating', {})
-                                if isinstance(rating_obj, dict) and rating_obj.get('ratingValue'):
-                                    rating_val = float(rating_obj['ratingValue'])
-                                    # Walmart sometimes stores as 1-5, sometimes as 0-100
-                                    if rating_val > 5:
-                                        rating_val = rating_val / 20  # Convert 0-100 to 0-5
-                                    review_data["rating"] = int(round(rating_val))
-                                    
-                                    # Debug first few
-                                    if len(result["reviews"]) < 3:
-                                        print(f"    Debug: Rating {rating_val} → {review_data['rating']} stars")
-                                
-                                # Title and body
-                                review_data["title"] = rev.get('name', '') or rev.get('headline', '')
-                                review_data["body"] = rev.get('reviewBody', '') or rev.get('description', '')
-                                review_data["created_at"] = rev.get('datePublished')
-                                
-                                if review_data["body"] or review_data["rating"]:
-                                    result["reviews"].append(review_data)
-                            except:
-                                continue
-                    
-                    break
-            except:
-                continue
-        
-        # If no reviews in JSON-LD, try to find in HTML
-        if not result["reviews"]:
-            print("  🔍 Looking for reviews in HTML...")
-            
-            # Try different selectors
-            review_elements = (
-                soup.find_all('div', {'data-testid': re.compile(r'review', re.I)}) or
-                soup.find_all('div', class_=re.compile(r'review', re.I)) or
-                soup.find_all('section', class_=re.compile(r'review', re.I))
-            )
-            
-            print(f"  📝 Found {len(review_elements)} review elements in HTML")
-            
-            for idx, rev_el in enumerate(review_elements[:max_reviews]):
-                try:
-                    review_data = {
-                        "review_id": None,
-                        "author_name": "Anonymous",
-                        "rating": None,
-                        "title": "",
-                        "body": "",
-                        "created_at": None,
-                        "verified_purchase": False,
-                        "location": None,
-                        "helpful_count": 0,
-                        "not_helpful_count": 0,
-                        "images": [],
-                    }
-                    
-                    # Try to extract rating
-                    rating_text = rev_el.get_text()
-                    rating_match = re.search(r'(\d+)\s*(?:star|out of)', rating_text, re.I)
-                    if rating_match:
-                        review_data["rating"] = int(rating_match.group(1))
-                    
-                    # Title
-                    title_el = rev_el.find(['h3', 'h4', 'h5'])
-                    if title_el:
-                        review_data["title"] = title_el.get_text(strip=True)
-                    
-                    # Body
-                    body_el = rev_el.find('p')
-                    if body_el:
-                        review_data["body"] = body_el.get_text(strip=True)
-                    
-                    if review_data["body"] or review_data["title"]:
-                        result["reviews"].append(review_data)
-                except:
-                    continue
+        log.debug("✅ Page fetched! (%d chars)", len(html))
         
-        print(f"  ✓ Extracted {len(result['reviews'])} reviews")
-        
-        # Categorize best and worst  
-        if result["reviews"] and len(result["reviews"]) >= 2:
-            print("  🔍 Categorizing reviews...")
-            
-            rated = [r for r in result["reviews"] if r.get("rating") and r["rating"] > 0]
-            
-            if rated:
-                # Best: Only 4-5 stars
-                best = [r for r in rated if r["rating"] >= 4]
-                result["best_reviews"] = best[:5]
-                
-                # Worst: Only 1-3 stars
-                worst = [r for r in rated if r["rating"] <= 3]
-                result["worst_reviews"] = worst[:5]
-                
-                print(f"  ✓ {len(result['best_reviews'])} best (4-5★), {len(result['worst_reviews'])} worst (1-3★)")
-
+        # Parse off the event loop so other scrapes keep progressing meanwhile
+        parsed = await asyncio.to_thread(_parse_html, html, max_reviews)
+        result.update(parsed)
         
         if not result["reviews"]:
-            print("  ⚠️  No reviews found - product may not have reviews yet")
+            log.debug("⚠️  No reviews found for %s - product may not have reviews yet", item_id)
         
     except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Error scraping %s: %s", item_id, e)
         raise
     
-    print(f"✅ Completed! Reviews: {len(result['reviews'])}\n")
-    return result
\ No newline at end of file
+    # Don't cache empty extractions (e.g. blocked or challenge pages)
+    if result["product_title"] or result["reviews"]:
+        await _cache_put(item_id, max_reviews, result)
+    
+    log.debug("✅ Completed %s! Reviews: %d", item_id, len(result['reviews']))
+    return result